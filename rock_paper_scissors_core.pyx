@@ -3,11 +3,21 @@
 
 import numpy as np
 cimport numpy as np
-from libc.math cimport sqrt, hypot, cos, sin, M_PI
+from libc.math cimport sqrt, pow, cos, sin, M_PI
 from libc.stdlib cimport rand, RAND_MAX
+from cython.parallel cimport prange
 
 # Define constants
-cdef double MIN_DISTANCE = 10.0  # UNIT_RADIUS * 2
+# The collision radius (MIN_DISTANCE = UNIT_RADIUS * 2) and its square are C
+# compile-time constants, so the hot collision test compares against an
+# immediate instead of loading a module variable
+cdef extern from *:
+    """
+    #define RPS_MIN_DISTANCE 10.0
+    #define RPS_COLLISION_R2 (RPS_MIN_DISTANCE * RPS_MIN_DISTANCE)
+    """
+    const double MIN_DISTANCE "RPS_MIN_DISTANCE"
+    const double COLLISION_R2 "RPS_COLLISION_R2"
 cdef double REPULSION_FACTOR = 4.0
 cdef double REPULSION_RADIUS = 150.0
 cdef double UNIT_SPEED = 2.0
@@ -22,68 +32,203 @@ cdef double CENTER_FORCE = 0
 cdef int WIDTH = 960
 cdef int HEIGHT = 960
 
-# Type definitions
-ctypedef struct UnitStruct:
-    int unit_type
-    double x
-    double y
-    double vx
-    double vy
-    int target_index
+# Squared radii so that range tests can skip the square root
+cdef double STRONG_SEPARATION_SQ = (MIN_DISTANCE / 1.05) * (MIN_DISTANCE / 1.05)
+cdef double REPULSION_RADIUS_SQ = REPULSION_RADIUS * REPULSION_RADIUS
+cdef double GROUP_RADIUS_SQ = GROUP_RADIUS * GROUP_RADIUS
+cdef double GROUP_MIN_DISTANCE_SQ = GROUP_MIN_DISTANCE * GROUP_MIN_DISTANCE
+cdef double UNIT_SPEED_SQ = UNIT_SPEED * UNIT_SPEED
+
+# Loop invariants hoisted out of the per-unit and per-pair math
+cdef double HALF_WIDTH = WIDTH / 2
+cdef double HALF_HEIGHT = HEIGHT / 2
+cdef double ATTRACTION_SPEED = UNIT_SPEED * max(0.7, 1 - REPULSION_FACTOR / 2)
+cdef double INV_REPULSION_RADIUS = 1.0 / REPULSION_RADIUS
+cdef double INV_GROUP_MIN_DISTANCE = 1.0 / GROUP_MIN_DISTANCE
+cdef double STRONG_SEPARATION_FACTOR = 20.0 / MIN_DISTANCE
+
+# Uniform grid used to limit neighbour searches. Cells are at least
+# REPULSION_RADIUS wide, so every interaction partner of a unit lies in the
+# 3x3 block of cells around it (the grid wraps like the map does).
+cdef int GRID_W = <int>(WIDTH / REPULSION_RADIUS)
+cdef int GRID_H = <int>(HEIGHT / REPULSION_RADIUS)
+cdef int GRID_CELLS = GRID_W * GRID_H
+cdef double CELL_W = <double>WIDTH / GRID_W
+cdef double CELL_H = <double>HEIGHT / GRID_H
+# Units outside the 3x3 block around a unit are at least this far away (squared)
+cdef double GRID_REACH_SQ = min(CELL_W, CELL_H) * min(CELL_W, CELL_H)
+
+# Finer grid for the collision checks, which only reach MIN_DISTANCE
+cdef int COLLISION_GRID_W = <int>(WIDTH / (4 * MIN_DISTANCE))
+cdef int COLLISION_GRID_H = <int>(HEIGHT / (4 * MIN_DISTANCE))
+cdef int COLLISION_GRID_CELLS = COLLISION_GRID_W * COLLISION_GRID_H
 
 # Helper functions
-cdef double rand_double() nogil:
+cdef inline double rand_double() noexcept nogil:
     cdef double r = rand() / (RAND_MAX + 1.0)
     return r
 
-cdef double distance(double x1, double y1, double x2, double y2) nogil:
+cdef inline double distance_sq(double x1, double y1, double x2, double y2) noexcept nogil:
     # Calculate direct distance
     cdef double dx = x2 - x1
     cdef double dy = y2 - y1
     
     # Calculate wrap-around distance in x-direction
     cdef double wrap_dx = dx
-    if dx > WIDTH / 2:
+    if dx > HALF_WIDTH:
         wrap_dx = dx - WIDTH
-    elif dx < -WIDTH / 2:
+    elif dx < -HALF_WIDTH:
         wrap_dx = dx + WIDTH
         
     # Calculate wrap-around distance in y-direction
     cdef double wrap_dy = dy
-    if dy > HEIGHT / 2:
+    if dy > HALF_HEIGHT:
         wrap_dy = dy - HEIGHT
-    elif dy < -HEIGHT / 2:
+    elif dy < -HALF_HEIGHT:
         wrap_dy = dy + HEIGHT
     
-    # Return the shortest distance
-    return hypot(wrap_dx, wrap_dy)
+    # Return the squared shortest distance
+    return wrap_dx * wrap_dx + wrap_dy * wrap_dy
+
+cdef inline int cell_of(double x, double y, int grid_w, int grid_h) noexcept nogil:
+    """Index of the cell holding a position on a grid_w x grid_h grid"""
+    cdef int cx = <int>(x * grid_w / WIDTH)
+    cdef int cy = <int>(y * grid_h / HEIGHT)
+    
+    # Clamp positions sitting exactly on the far edge
+    if cx < 0:
+        cx = 0
+    elif cx >= grid_w:
+        cx = grid_w - 1
+    if cy < 0:
+        cy = 0
+    elif cy >= grid_h:
+        cy = grid_h - 1
+    
+    return cy * grid_w + cx
 
-cdef int is_inside_unit(double x, double y, double ux, double uy, double radius) nogil:
-    cdef double dist = distance(x, y, ux, uy)
-    return 1 if dist < radius else 0
+cdef void build_grid(float[:, ::1] positions, int unit_count, int grid_w, int grid_h,
+                     int[::1] cell_start, int[::1] cell_count, int[::1] cell_items) noexcept nogil:
+    """Bucket unit indices by grid cell (counting sort)"""
+    cdef int i, c
+    cdef int cells = grid_w * grid_h
+    cdef int offset = 0
+    
+    for c in range(cells):
+        cell_count[c] = 0
+    
+    for i in range(unit_count):
+        cell_count[cell_of(positions[i, 0], positions[i, 1], grid_w, grid_h)] += 1
+    
+    # cell_start temporarily holds the end of each bucket
+    for c in range(cells):
+        offset += cell_count[c]
+        cell_start[c] = offset
+    
+    # Fill buckets back to front so each one keeps ascending unit order
+    for i in range(unit_count - 1, -1, -1):
+        c = cell_of(positions[i, 0], positions[i, 1], grid_w, grid_h)
+        cell_start[c] -= 1
+        cell_items[cell_start[c]] = i
+
+cdef void partition_by_type(np.int8_t[::1] types, int unit_count, int[::1] type_start,
+                            int[::1] type_items) noexcept nogil:
+    """Group unit indices by type; type t owns type_items[type_start[t]:type_start[t + 1]]"""
+    cdef int i, t
+    
+    for t in range(4):
+        type_start[t] = 0
+    
+    for i in range(unit_count):
+        type_start[types[i]] += 1
+    
+    # type_start temporarily holds the end of each bucket
+    for t in range(1, 3):
+        type_start[t] += type_start[t - 1]
+    type_start[3] = unit_count
+    
+    # Fill buckets back to front so each one keeps ascending unit order
+    for i in range(unit_count - 1, -1, -1):
+        t = types[i]
+        type_start[t] -= 1
+        type_items[type_start[t]] = i
 
-cdef int find_target(int unit_type, double unit_x, double unit_y, 
-                    double[:, :] positions, int[:] types, int unit_count) nogil:
-    """Find nearest target unit that this unit can chase"""
+cdef int scan_target(int unit_type, double unit_x, double unit_y, float[:, ::1] positions,
+                     int[::1] type_start, int[::1] type_items) noexcept nogil:
+    """Find nearest target unit that this unit can chase by scanning its whole type"""
     cdef int target_type = (unit_type + 2) % 3
-    cdef double min_dist = 1e9
+    cdef double min_dist_sq = 1e18
     cdef int target_index = -1
-    cdef double d
-    cdef int i
+    cdef double d2
+    cdef int i, k
     
-    # Find the closest target
-    for i in range(unit_count):
-        if types[i] == target_type:
-            d = distance(unit_x, unit_y, positions[i, 0], positions[i, 1])
-            if d < min_dist:
-                min_dist = d
-                target_index = i
+    # Find the closest target among the units of the target type
+    for k in range(type_start[target_type], type_start[target_type + 1]):
+        i = type_items[k]
+        d2 = distance_sq(unit_x, unit_y, positions[i, 0], positions[i, 1])
+        if d2 < min_dist_sq:
+            min_dist_sq = d2
+            target_index = i
     
     return target_index
 
-cdef void calculate_movement(int unit_index, double[:, :] positions, int[:] types, 
-                           double[:, :] velocities, int[:] targets, int unit_count) nogil:
-    """Calculate movement for a single unit"""
+cdef inline void consider_target(int i, double d2, int* target_index,
+                                 double* target_dist_sq) noexcept nogil:
+    """Take unit i at squared distance d2 as the target if it is the closest so far
+    (lowest index on ties, as a full scan would)"""
+    if d2 < target_dist_sq[0] or (d2 == target_dist_sq[0] and i < target_index[0]):
+        target_dist_sq[0] = d2
+        target_index[0] = i
+
+cdef inline int settle_target(int target_index, double target_dist_sq, int unit_type,
+                              double unit_x, double unit_y, float[:, ::1] positions,
+                              int[::1] type_start, int[::1] type_items) noexcept nogil:
+    """The target found in the neighbouring cells, or the result of a full scan
+    if that one may not be the closest"""
+    # A target beyond the reach of the neighbouring cells may not be the
+    # closest one, so fall back to scanning every unit of the target type
+    if target_dist_sq >= GRID_REACH_SQ:
+        return scan_target(unit_type, unit_x, unit_y, positions, type_start, type_items)
+    return target_index
+
+cdef int find_target(int unit_index, float[:, ::1] positions, np.int8_t[::1] types,
+                     int[::1] cell_start, int[::1] cell_count, int[::1] cell_items,
+                     int[::1] type_start, int[::1] type_items) noexcept nogil:
+    """Find nearest target unit that this unit can chase, searching the neighbouring cells first"""
+    cdef double unit_x = positions[unit_index, 0]
+    cdef double unit_y = positions[unit_index, 1]
+    cdef int unit_type = types[unit_index]
+    cdef int target_type = (unit_type + 2) % 3
+    cdef int target_index = -1
+    cdef double target_dist_sq = 1e18
+    cdef int home_cell = cell_of(unit_x, unit_y, GRID_W, GRID_H)
+    cdef int home_x = home_cell % GRID_W
+    cdef int home_y = home_cell / GRID_W
+    cdef int ox, oy, c, k, i
+    cdef double d2
+    
+    for oy in range(-1, 2):
+        for ox in range(-1, 2):
+            c = ((home_y + oy + GRID_H) % GRID_H) * GRID_W + (home_x + ox + GRID_W) % GRID_W
+            
+            for k in range(cell_start[c], cell_start[c] + cell_count[c]):
+                i = cell_items[k]
+                if types[i] != target_type:
+                    continue
+                
+                d2 = distance_sq(unit_x, unit_y, positions[i, 0], positions[i, 1])
+                consider_target(i, d2, &target_index, &target_dist_sq)
+    
+    return settle_target(target_index, target_dist_sq, unit_type, unit_x, unit_y,
+                         positions, type_start, type_items)
+
+cdef void calculate_movement(int unit_index, float[:, ::1] positions, np.int8_t[::1] types, 
+                           float[:, ::1] prev_velocities, float[:, ::1] velocities,
+                           int[::1] targets, float[:, ::1] noise,
+                           int[::1] cell_start, int[::1] cell_count, int[::1] cell_items,
+                           int[::1] type_start, int[::1] type_items, bint find_targets) noexcept nogil:
+    """Find the target of a single unit (unless find_targets is off, in which case
+    targets already holds it) and calculate its movement"""
     cdef double unit_x = positions[unit_index, 0]
     cdef double unit_y = positions[unit_index, 1]
     cdef int unit_type = types[unit_index]
@@ -92,67 +237,20 @@ cdef void calculate_movement(int unit_index, double[:, :] positions, int[:] type
     cdef double vx = 0.0
     cdef double vy = 0.0
     
-    # Get target information
-    cdef int target_index = targets[unit_index]
-    cdef double dx, dy, dist, strength
+    cdef double dx, dy, d2, dist, strength
     
-    # Attraction to target
-    if target_index >= 0:
-        # Get the raw distance vector
-        dx = positions[target_index, 0] - unit_x
-        dy = positions[target_index, 1] - unit_y
-        
-        # Check for wrap-around shorter path in x-direction
-        if dx > WIDTH / 2:
-            dx = dx - WIDTH
-        elif dx < -WIDTH / 2:
-            dx = dx + WIDTH
-            
-        # Check for wrap-around shorter path in y-direction
-        if dy > HEIGHT / 2:
-            dy = dy - HEIGHT
-        elif dy < -HEIGHT / 2:
-            dy = dy + HEIGHT
-        
-        dist = hypot(dx, dy)
-        
-        if dist > 0:
-            # Attraction force
-            strength = max(0.7, 1 - REPULSION_FACTOR/2)
-            vx = (dx / dist) * UNIT_SPEED * strength
-            vy = (dy / dist) * UNIT_SPEED * strength
-    
-    # Repulsion from threats (units that can defeat this unit)
+    # Nearest target, repulsion from threats (units that can defeat this
+    # unit), group behavior with same type units and global separation, all
+    # gathered in one pass over the neighbouring cells
+    cdef int target_type = (unit_type + 2) % 3
     cdef int predator_type = (unit_type + 1) % 3
-    cdef int i
-    
-    for i in range(unit_count):
-        if i != unit_index and types[i] == predator_type:
-            # Get the raw distance vector (towards the unit)
-            dx = unit_x - positions[i, 0]
-            dy = unit_y - positions[i, 1]
-            
-            # Check for wrap-around shorter path in x-direction
-            if dx > WIDTH / 2:
-                dx = dx - WIDTH
-            elif dx < -WIDTH / 2:
-                dx = dx + WIDTH
-                
-            # Check for wrap-around shorter path in y-direction
-            if dy > HEIGHT / 2:
-                dy = dy - HEIGHT
-            elif dy < -HEIGHT / 2:
-                dy = dy + HEIGHT
-            
-            dist = hypot(dx, dy)
-            
-            if 0 < dist < REPULSION_RADIUS:
-                # Repulsion force
-                strength = REPULSION_FACTOR * (1 - dist / REPULSION_RADIUS)
-                vx += (dx / dist) * strength
-                vy += (dy / dist) * strength
+    cdef int target_index = -1
+    cdef double target_dist_sq = 1e18
+    cdef int home_cell = cell_of(unit_x, unit_y, GRID_W, GRID_H)
+    cdef int home_x = home_cell % GRID_W
+    cdef int home_y = home_cell / GRID_W
+    cdef int ox, oy, c, k, i
     
-    # Group behavior with same type units
     cdef double sep_x = 0.0
     cdef double sep_y = 0.0
     cdef int sep_count = 0
@@ -161,44 +259,113 @@ cdef void calculate_movement(int unit_index, double[:, :] positions, int[:] type
     cdef int group_count = 0
     cdef double avg_vx = 0.0
     cdef double avg_vy = 0.0
+    cdef double strong_sep_x = 0.0
+    cdef double strong_sep_y = 0.0
+    cdef double force
     
-    for i in range(unit_count):
-        if i != unit_index and types[i] == unit_type:
-            dx = unit_x - positions[i, 0]
-            dy = unit_y - positions[i, 1]
+    for oy in range(-1, 2):
+        for ox in range(-1, 2):
+            c = ((home_y + oy + GRID_H) % GRID_H) * GRID_W + (home_x + ox + GRID_W) % GRID_W
             
-            # Check for wrap-around shorter path in x-direction
-            if dx > WIDTH / 2:
-                dx = dx - WIDTH
-            elif dx < -WIDTH / 2:
-                dx = dx + WIDTH
+            for k in range(cell_start[c], cell_start[c] + cell_count[c]):
+                i = cell_items[k]
+                if i == unit_index:
+                    continue
                 
-            # Check for wrap-around shorter path in y-direction
-            if dy > HEIGHT / 2:
-                dy = dy - HEIGHT
-            elif dy < -HEIGHT / 2:
-                dy = dy + HEIGHT
+                # Get the raw distance vector (towards the unit)
+                dx = unit_x - positions[i, 0]
+                dy = unit_y - positions[i, 1]
                 
-            dist = hypot(dx, dy)
-            
-            if dist < GROUP_RADIUS:
-                # Count this unit for group calculations
-                group_count += 1
+                # Check for wrap-around shorter path in x-direction
+                if dx > HALF_WIDTH:
+                    dx = dx - WIDTH
+                elif dx < -HALF_WIDTH:
+                    dx = dx + WIDTH
+                    
+                # Check for wrap-around shorter path in y-direction
+                if dy > HALF_HEIGHT:
+                    dy = dy - HEIGHT
+                elif dy < -HALF_HEIGHT:
+                    dy = dy + HEIGHT
+                
+                d2 = dx * dx + dy * dy
+                
+                # Track the closest target
+                if types[i] == target_type:
+                    consider_target(i, d2, &target_index, &target_dist_sq)
+                
+                # REPULSION_RADIUS is the largest interaction radius
+                if d2 >= REPULSION_RADIUS_SQ:
+                    continue
                 
-                # Separation - avoid crowding neighbors
-                if dist < GROUP_MIN_DISTANCE and dist > 0:
-                    strength = 1.0 - (dist / GROUP_MIN_DISTANCE)
-                    sep_x += (dx / dist) * strength
-                    sep_y += (dy / dist) * strength
-                    sep_count += 1
+                # Global separation: force all units to avoid overlapping
+                if 0 < d2 < STRONG_SEPARATION_SQ:
+                    # Strong separation force
+                    dist = sqrt(d2)
+                    force = STRONG_SEPARATION_FACTOR * (MIN_DISTANCE - dist)
+                    strong_sep_x += (dx / dist) * force
+                    strong_sep_y += (dy / dist) * force
                 
-                # Add to center of mass calculation
-                center_x += positions[i, 0]
-                center_y += positions[i, 1]
+                if types[i] == predator_type:
+                    if d2 > 0:
+                        # Repulsion force
+                        dist = sqrt(d2)
+                        strength = REPULSION_FACTOR * (1 - dist * INV_REPULSION_RADIUS)
+                        vx += (dx / dist) * strength
+                        vy += (dy / dist) * strength
                 
-                # Add to velocity alignment
-                avg_vx += velocities[i, 0]
-                avg_vy += velocities[i, 1]
+                elif types[i] == unit_type and d2 < GROUP_RADIUS_SQ:
+                    # Count this unit for group calculations
+                    group_count += 1
+                    
+                    # Separation - avoid crowding neighbors
+                    if 0 < d2 < GROUP_MIN_DISTANCE_SQ:
+                        dist = sqrt(d2)
+                        strength = 1.0 - dist * INV_GROUP_MIN_DISTANCE
+                        sep_x += (dx / dist) * strength
+                        sep_y += (dy / dist) * strength
+                        sep_count += 1
+                    
+                    # Add to center of mass calculation
+                    center_x += positions[i, 0]
+                    center_y += positions[i, 1]
+                    
+                    # Add to velocity alignment
+                    avg_vx += prev_velocities[i, 0]
+                    avg_vy += prev_velocities[i, 1]
+    
+    if find_targets:
+        target_index = settle_target(target_index, target_dist_sq, unit_type, unit_x, unit_y,
+                                     positions, type_start, type_items)
+        targets[unit_index] = target_index
+    else:
+        target_index = targets[unit_index]
+    
+    # Attraction to target
+    if target_index >= 0:
+        # Get the raw distance vector
+        dx = positions[target_index, 0] - unit_x
+        dy = positions[target_index, 1] - unit_y
+        
+        # Check for wrap-around shorter path in x-direction
+        if dx > HALF_WIDTH:
+            dx = dx - WIDTH
+        elif dx < -HALF_WIDTH:
+            dx = dx + WIDTH
+            
+        # Check for wrap-around shorter path in y-direction
+        if dy > HALF_HEIGHT:
+            dy = dy - HEIGHT
+        elif dy < -HALF_HEIGHT:
+            dy = dy + HEIGHT
+        
+        d2 = dx * dx + dy * dy
+        
+        if d2 > 0:
+            # Attraction force
+            dist = sqrt(d2)
+            vx += (dx / dist) * ATTRACTION_SPEED
+            vy += (dy / dist) * ATTRACTION_SPEED
     
     # Apply separation if any neighbors are too close
     if sep_count > 0:
@@ -213,9 +380,10 @@ cdef void calculate_movement(int unit_index, double[:, :] positions, int[:] type
         # Only apply cohesion if not too close to center of mass
         dx = center_x - unit_x
         dy = center_y - unit_y
-        dist = hypot(dx, dy)
+        d2 = dx * dx + dy * dy
         
-        if dist > GROUP_MIN_DISTANCE:
+        if d2 > GROUP_MIN_DISTANCE_SQ:
+            dist = sqrt(d2)
             vx += (dx / dist) * GROUP_COHESION
             vy += (dy / dist) * GROUP_COHESION
         
@@ -228,46 +396,19 @@ cdef void calculate_movement(int unit_index, double[:, :] positions, int[:] type
         # We've removed center attraction force since we have cyclic boundaries now
         # This lets units freely explore the entire space without biasing toward center
     
-    # Add random movement
-    vx += (rand_double() - 0.5) * RANDOM_MOVEMENT
-    vy += (rand_double() - 0.5) * RANDOM_MOVEMENT
-    
-    # --- Global separation: force all units to avoid overlapping ---
-    cdef double strong_sep_x = 0.0
-    cdef double strong_sep_y = 0.0
-    cdef double force
-    
-    for i in range(unit_count):
-        if i != unit_index:
-            dx = unit_x - positions[i, 0]
-            dy = unit_y - positions[i, 1]
-            
-            # Check for wrap-around shorter path in x-direction
-            if dx > WIDTH / 2:
-                dx = dx - WIDTH
-            elif dx < -WIDTH / 2:
-                dx = dx + WIDTH
-                
-            # Check for wrap-around shorter path in y-direction
-            if dy > HEIGHT / 2:
-                dy = dy - HEIGHT
-            elif dy < -HEIGHT / 2:
-                dy = dy + HEIGHT
-                
-            dist = hypot(dx, dy)
-            
-            if dist < MIN_DISTANCE/1.05 and dist > 0:
-                # Strong separation force
-                force = 20.0 * (MIN_DISTANCE - dist) / MIN_DISTANCE
-                strong_sep_x += (dx / dist) * force
-                strong_sep_y += (dy / dist) * force
+    # Add random movement (noise holds uniform samples in [0, 1))
+    vx += (noise[unit_index, 0] - 0.5) * RANDOM_MOVEMENT
+    vy += (noise[unit_index, 1] - 0.5) * RANDOM_MOVEMENT
     
+    # Apply global separation
     vx += strong_sep_x
     vy += strong_sep_y
     
     # Normalize velocity if too high
-    cdef double speed = hypot(vx, vy)
-    if speed > UNIT_SPEED:
+    cdef double speed
+    cdef double speed_sq = vx * vx + vy * vy
+    if speed_sq > UNIT_SPEED_SQ:
+        speed = sqrt(speed_sq)
         vx = (vx / speed) * UNIT_SPEED
         vy = (vy / speed) * UNIT_SPEED
     
@@ -275,10 +416,10 @@ cdef void calculate_movement(int unit_index, double[:, :] positions, int[:] type
     velocities[unit_index, 0] = vx
     velocities[unit_index, 1] = vy
 
-cdef void apply_movement(int unit_count, double[:, :] positions, double[:, :] velocities) nogil:
+cdef void apply_movement(int unit_count, float[:, ::1] positions, float[:, ::1] velocities) noexcept nogil:
     """Apply calculated velocities to positions and handle cyclic boundaries"""
     cdef int i
-    cdef double x, y, vx, vy
+    cdef float x, y, vx, vy
     
     for i in range(unit_count):
         # Get current position and velocity
@@ -310,69 +451,169 @@ cdef void apply_movement(int unit_count, double[:, :] positions, double[:, :] ve
         velocities[i, 0] = vx
         velocities[i, 1] = vy
 
-cdef void check_collisions(int unit_count, double[:, :] positions, int[:] types, int[:] new_types) nogil:
+cdef int count_hits(int unit_index, int predator_type, float[:, ::1] positions,
+                    np.int8_t[::1] types, int[::1] cell_start, int[::1] cell_count,
+                    int[::1] cell_items) noexcept nogil:
+    """Count the predators touching a unit; they all lie in the 3x3 block of
+    collision cells around it"""
+    cdef double unit_x = positions[unit_index, 0]
+    cdef double unit_y = positions[unit_index, 1]
+    cdef int home_cell = cell_of(unit_x, unit_y, COLLISION_GRID_W, COLLISION_GRID_H)
+    cdef int home_x = home_cell % COLLISION_GRID_W
+    cdef int home_y = home_cell / COLLISION_GRID_W
+    cdef int hits = 0
+    cdef int ox, oy, c, k, j
+    
+    for oy in range(-1, 2):
+        for ox in range(-1, 2):
+            c = (((home_y + oy + COLLISION_GRID_H) % COLLISION_GRID_H) * COLLISION_GRID_W
+                 + (home_x + ox + COLLISION_GRID_W) % COLLISION_GRID_W)
+            
+            for k in range(cell_start[c], cell_start[c] + cell_count[c]):
+                j = cell_items[k]
+                if types[j] != predator_type:
+                    continue
+                
+                if distance_sq(unit_x, unit_y, positions[j, 0], positions[j, 1]) < COLLISION_R2:
+                    hits += 1
+    
+    return hits
+
+cdef void check_collisions(int unit_count, float[:, ::1] positions, np.int8_t[::1] types,
+                           int[::1] cell_start, int[::1] cell_count, int[::1] cell_items,
+                           double[::1] rolls, np.int8_t[::1] new_types) noexcept nogil:
     """Check for collisions between units and update types"""
-    cdef int i, j
+    cdef int n, i
     cdef int predator_type
-    cdef double dist
+    cdef int hits
     
-    for i in range(unit_count):
+    # Units are independent, so split them over threads; visiting them cell
+    # by cell gives each thread a compact block of the map
+    for n in prange(unit_count, schedule='static'):
+        i = cell_items[n]
         if new_types[i] < 0:  # Only check if not already changed
             predator_type = (types[i] + 1) % 3
+            hits = count_hits(i, predator_type, positions, types, cell_start, cell_count,
+                              cell_items)
             
-            for j in range(unit_count):
-                if i != j and types[j] == predator_type:
-                    dist = distance(positions[i, 0], positions[i, 1], 
-                                   positions[j, 0], positions[j, 1])
-                    
-                    if dist < MIN_DISTANCE:
-                        # Collision occurred, check if type should change
-                        if rand_double() < COLLISION_CHANCE:
-                            new_types[i] = predator_type
-                            break
+            # One roll per unit: converting with probability 1 - (1 - p)^hits is
+            # the same as rolling COLLISION_CHANCE once per colliding predator
+            if hits > 0 and rolls[i] < 1.0 - pow(1.0 - COLLISION_CHANCE, hits):
+                new_types[i] = predator_type
+
+cdef class GridBuffers:
+    """Scratch grid and type buckets for up to unit_count units.
+    
+    Pass one to the functions below to reuse the buckets across frames
+    instead of allocating them on every call. A GridBuffers must not be
+    shared by calls running at the same time.
+    """
+    cdef readonly int unit_count
+    cdef int[::1] grid_start, grid_count, grid_items
+    cdef int[::1] collision_start, collision_count, collision_items
+    cdef int[::1] type_start, type_items
+    
+    def __init__(self, int unit_count):
+        self.unit_count = unit_count
+        self.grid_start = np.empty(GRID_CELLS, dtype=np.int32)
+        self.grid_count = np.empty(GRID_CELLS, dtype=np.int32)
+        self.grid_items = np.empty(unit_count, dtype=np.int32)
+        self.collision_start = np.empty(COLLISION_GRID_CELLS, dtype=np.int32)
+        self.collision_count = np.empty(COLLISION_GRID_CELLS, dtype=np.int32)
+        self.collision_items = np.empty(unit_count, dtype=np.int32)
+        self.type_start = np.empty(4, dtype=np.int32)
+        self.type_items = np.empty(unit_count, dtype=np.int32)
+
+cdef GridBuffers get_buffers(object buffers, int unit_count):
+    """The caller's scratch buffers, or fresh ones for a single call"""
+    if buffers is None:
+        return GridBuffers(unit_count)
+    cdef GridBuffers checked = <GridBuffers?>buffers
+    if checked.unit_count < unit_count:
+        raise ValueError(f"buffers hold {checked.unit_count} units, {unit_count} needed")
+    return checked
 
 # Python-accessible functions
-def find_all_targets(np.ndarray[double, ndim=2] positions, np.ndarray[int, ndim=1] types):
-    """Find targets for all units"""
+def find_all_targets(float[:, ::1] positions, np.int8_t[::1] types, out=None, buffers=None):
+    """Find targets for all units (into out, if given)"""
     cdef int unit_count = positions.shape[0]
-    cdef np.ndarray[int, ndim=1] targets = np.full(unit_count, -1, dtype=np.int32)
+    targets = np.empty(unit_count, dtype=np.int32) if out is None else out
+    cdef int[::1] targets_view = targets
+    cdef GridBuffers buf = get_buffers(buffers, unit_count)
     cdef int i
     
-    for i in range(unit_count):
-        targets[i] = find_target(types[i], positions[i, 0], positions[i, 1],
-                               positions, types, unit_count)
+    with nogil:
+        build_grid(positions, unit_count, GRID_W, GRID_H, buf.grid_start, buf.grid_count,
+                   buf.grid_items)
+        partition_by_type(types, unit_count, buf.type_start, buf.type_items)
+        
+        for i in range(unit_count):
+            targets_view[i] = find_target(i, positions, types, buf.grid_start, buf.grid_count,
+                                          buf.grid_items, buf.type_start, buf.type_items)
     
     return targets
 
-def update_movement(np.ndarray[double, ndim=2] positions, 
-                   np.ndarray[int, ndim=1] types,
-                   np.ndarray[int, ndim=1] targets):
-    """Update positions for all units"""
+def update_movement(float[:, ::1] positions, 
+                   np.int8_t[::1] types,
+                   float[:, ::1] velocities,
+                   int[::1] targets,
+                   float[:, ::1] noise,
+                   bint find_targets=True,
+                   out=None,
+                   buffers=None):
+    """Find targets (written into targets) and update positions for all units,
+    given last frame's velocities and (N, 2) uniform noise samples, and return
+    the new velocities (written into out, if given; it must not overlap velocities).
+    With find_targets=False the targets passed in are used as they are."""
     cdef int unit_count = positions.shape[0]
-    cdef np.ndarray[double, ndim=2] velocities = np.zeros((unit_count, 2), dtype=np.float64)
-    cdef int i
+    # Neighbours' velocities are read from velocities while other threads write out
+    if out is not None and np.shares_memory(out, velocities):
+        raise ValueError("out must not share memory with velocities")
+    new_velocities = np.empty((unit_count, 2), dtype=np.float32) if out is None else out
+    cdef float[:, ::1] new_velocities_view = new_velocities
+    cdef GridBuffers buf = get_buffers(buffers, unit_count)
+    cdef int k
     
-    # Calculate movements for all units
-    for i in range(unit_count):
-        calculate_movement(i, positions, types, velocities, targets, unit_count)
-    
-    # Apply movements to all units
-    apply_movement(unit_count, positions, velocities)
+    with nogil:
+        build_grid(positions, unit_count, GRID_W, GRID_H, buf.grid_start, buf.grid_count,
+                   buf.grid_items)
+        partition_by_type(types, unit_count, buf.type_start, buf.type_items)
+        
+        # Find targets and calculate movements for all units, split over threads
+        # (each unit only writes its own target and velocity). Going cell by
+        # cell, consecutive units walk (mostly) the same neighbouring cells.
+        for k in prange(unit_count, schedule='static'):
+            calculate_movement(buf.grid_items[k], positions, types, velocities,
+                               new_velocities_view, targets, noise, buf.grid_start,
+                               buf.grid_count, buf.grid_items, buf.type_start, buf.type_items,
+                               find_targets)
+        
+        # Apply movements to all units
+        apply_movement(unit_count, positions, new_velocities_view)
     
-    return velocities
+    return new_velocities
 
-def check_all_collisions(np.ndarray[double, ndim=2] positions, np.ndarray[int, ndim=1] types):
-    """Check collisions for all units and return new types"""
+def check_all_collisions(float[:, ::1] positions, np.int8_t[::1] types, double[::1] rolls,
+                         out=None, buffers=None):
+    """Check collisions for all units, given one uniform roll per unit, and return new types
+    (written into out, if given; -1 for units that keep their type)"""
     cdef int unit_count = positions.shape[0]
-    cdef np.ndarray[int, ndim=1] new_types = np.full(unit_count, -1, dtype=np.int32)
+    new_types = np.empty(unit_count, dtype=np.int8) if out is None else out
+    cdef np.int8_t[::1] new_types_view = new_types
+    cdef GridBuffers buf = get_buffers(buffers, unit_count)
     
-    check_collisions(unit_count, positions, types, new_types)
+    with nogil:
+        new_types_view[:] = -1
+        build_grid(positions, unit_count, COLLISION_GRID_W, COLLISION_GRID_H,
+                   buf.collision_start, buf.collision_count, buf.collision_items)
+        check_collisions(unit_count, positions, types, buf.collision_start,
+                         buf.collision_count, buf.collision_items, rolls, new_types_view)
     
     return new_types
 
 def initialize_random_positions(int count, int width, int height, int radius):
     """Generate random positions for units"""
-    cdef np.ndarray[double, ndim=2] positions = np.zeros((count, 2), dtype=np.float64)
+    cdef np.ndarray[float, ndim=2] positions = np.zeros((count, 2), dtype=np.float32)
     cdef int i
     
     for i in range(count):
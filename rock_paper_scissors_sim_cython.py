@@ -1,25 +1,23 @@
+import os
+import itertools
 import pygame
 import numpy as np
 import random
 import sys
-import math
 import time
-from shapely.geometry import Point, Polygon
+import shapely
 
-# Import our Cython-optimized core
-import rock_paper_scissors_core as core
-
-# Initialize Pygame
-pygame.init()
+# Import our Cython-optimized core (compiled ahead of time, see setup.py)
+try:
+    import rock_paper_scissors_core as core
+except ImportError as exc:
+    raise ImportError("rock_paper_scissors_core is not built, run "
+                      "'python setup.py build_ext --inplace' first") from exc
 
 # Constants
 WIDTH, HEIGHT = 960, 960
 FPS = 144
-
-# Benchmark support
-if len(sys.argv) >= 5 and sys.argv[4] == '-b':
-    MAX_TIME = int(sys.argv[5])
-    print(f'Running in benchmark mode with MAX_TIME={MAX_TIME}')
+PERF_TEXT_INTERVAL = 10  # frames between refreshes of the performance text
 
 MAX_TIME = 30000  # frames before declaring a draw
 BACKGROUND_COLOR = (30, 30, 30)
@@ -33,13 +31,32 @@ UNIT_RADIUS = 5
 SCISSORS_COLOR = (255, 0, 0)      # Red
 ROCK_COLOR = (100, 100, 100)      # Gray
 PAPER_COLOR = (0, 0, 255)         # Blue
+UNIT_COLORS = (SCISSORS_COLOR, ROCK_COLOR, PAPER_COLOR)  # Indexed by unit type
 SHOW_ATTRACTIONS = False          # Whether to show attraction/repulsion lines
 
-# Initialize screen
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Rock Paper Scissors Simulation (Cython)")
+# Targeting: True finds targets on the core's neighbour grid, False uses the
+# brute-force NumPy fallback below
+GRID_TARGETS = True
+
+# Drawing surface, created in main() (a window, or off-screen when headless)
+screen = None
 clock = pygame.time.Clock()
 
+# Rendered HUD text surfaces keyed by (text, color), oldest evicted first
+TEXT_CACHE_SIZE = 64
+_text_cache = {}
+
+def render_text(font, text, color):
+    """Render HUD text, reusing the cached surface while the text is unchanged"""
+    key = (text, color)
+    surface = _text_cache.get(key)
+    if surface is None:
+        if len(_text_cache) >= TEXT_CACHE_SIZE:
+            del _text_cache[next(iter(_text_cache))]
+        surface = font.render(text, True, color)
+        _text_cache[key] = surface
+    return surface
+
 class Obstacle:
     def __init__(self):
         # Generate a random polygon with 3-7 vertices
@@ -47,241 +64,339 @@ class Obstacle:
         center_x = random.randint(100, WIDTH - 100)
         center_y = random.randint(100, HEIGHT - 100)
         
-        # Generate random vertices around the center
+        # Generate random vertices around the center, with some randomness in the angles
         radius = random.randint(30, 70)
-        vertices = []
-        for i in range(num_vertices):
-            angle = 2 * math.pi * i / num_vertices
-            # Add some randomness to the angle
-            angle += random.uniform(-0.2, 0.2)
-            x = center_x + radius * math.cos(angle)
-            y = center_y + radius * math.sin(angle)
-            vertices.append((x, y))
-        
-        self.vertices = vertices
-        self.polygon = Polygon(vertices)
+        angles = 2 * np.pi * np.arange(num_vertices) / num_vertices
+        # (the generator is seeded from random, so seeding random reproduces the obstacle)
+        rng = np.random.default_rng(random.getrandbits(64))
+        angles += rng.uniform(-0.2, 0.2, num_vertices)
+        
+        # Vertices as a (V, 2) array, and as a list for drawing
+        self.verts = np.stack([center_x + radius * np.cos(angles),
+                               center_y + radius * np.sin(angles)], axis=1)
+        self.vertices = self.verts.tolist()
+        
+        # Prepared shapely polygon
+        self.polygon = shapely.polygons(self.verts)
+        shapely.prepare(self.polygon)
     
-    def draw(self):
-        pygame.draw.polygon(screen, OBSTACLE_COLOR, self.vertices)
+    def draw(self, surface):
+        pygame.draw.polygon(surface, OBSTACLE_COLOR, self.vertices)
+
+def render_background(obstacles=()):
+    """Render the static background (fill color and obstacles) once"""
+    background = pygame.Surface((WIDTH, HEIGHT))
+    background.fill(BACKGROUND_COLOR)
+    for obstacle in obstacles:
+        obstacle.draw(background)
+    return background
+
+def find_targets_np(positions, types):
+    """Nearest prey of every unit (-1 if there is none) by NumPy broadcasting"""
+    if len(types) == 0:
+        return np.full(len(types), -1, dtype=np.int32)
+    
+    # Pairwise distances, taking the shorter way around the wrapping map
+    # (in float64, like the core)
+    p = positions.astype(np.float64)
+    diff = np.abs(p[:, None, :] - p[None, :, :])
+    diff = np.minimum(diff, (WIDTH, HEIGHT) - diff)
+    d2 = (diff * diff).sum(axis=2)
+    
+    # Only units of the prey type count; argmin keeps the lowest index on ties
+    prey_types = (types + 2) % 3
+    d2[types[None, :] != prey_types[:, None]] = np.inf
+    targets = d2.argmin(axis=1).astype(np.int32)
+    targets[np.isinf(d2[np.arange(len(targets)), targets])] = -1
+    return targets
 
 class CythonSimulation:
     def __init__(self, scissors_count, rock_count, paper_count):
         self.total_count = scissors_count + rock_count + paper_count
         
         # Initialize positions
-        self.positions = np.zeros((self.total_count, 2), dtype=np.float64)
+        self.positions = np.zeros((self.total_count, 2), dtype=np.float32)
         
         # Initialize unit types (0: Scissors, 1: Rock, 2: Paper)
-        self.types = np.zeros(self.total_count, dtype=np.int32)
+        self.types = np.zeros(self.total_count, dtype=np.int8)
         
         # Set initial positions and types
         self.initialize_units(scissors_count, rock_count, paper_count)
         
+        # Running count of each unit type, updated as units convert
+        self.counts = np.bincount(self.types, minlength=3)
+        
         # Initialize targets array
         self.targets = np.full(self.total_count, -1, dtype=np.int32)
         
-        # Initialize velocities
-        self.velocities = np.zeros((self.total_count, 2), dtype=np.float64)
+        # Initialize velocities, plus a second buffer the core writes the next
+        # frame's velocities into (the two are swapped after every update)
+        self.velocities = np.zeros((self.total_count, 2), dtype=np.float32)
+        self._next_velocities = np.empty_like(self.velocities)
+        
+        # Random generator for the per-frame movement noise and collision rolls,
+        # and buffers reused every frame for those and the collision results
+        self.rng = np.random.default_rng()
+        self._noise = np.empty((self.total_count, 2), dtype=np.float32)
+        self._rolls = np.empty(self.total_count, dtype=np.float64)
+        self._new_types = np.empty(self.total_count, dtype=np.int8)
+        
+        # Scratch grid and type buckets for the core, reused every frame
+        self._grid_buffers = core.GridBuffers(self.total_count)
+        
+        # Pre-render one unit sprite per type so drawing is a batch of blits
+        self.sprites = []
+        for color in UNIT_COLORS:
+            sprite = pygame.Surface((2 * UNIT_RADIUS, 2 * UNIT_RADIUS), pygame.SRCALPHA)
+            pygame.draw.circle(sprite, color, (UNIT_RADIUS, UNIT_RADIUS), UNIT_RADIUS)
+            
+            # Match the window's pixel format so blits need no conversion
+            if pygame.display.get_surface() is not None:
+                sprite = sprite.convert_alpha()
+            self.sprites.append(sprite)
 
     def initialize_units(self, scissors_count, rock_count, paper_count):
         """Initialize unit positions and types"""
         # Generate all positions at once
         self.positions = core.initialize_random_positions(self.total_count, WIDTH, HEIGHT, UNIT_RADIUS)
         
-        # Set types
-        idx = 0
-        
-        # Scissors (type 0)
-        for i in range(scissors_count):
-            self.types[idx] = 0
-            idx += 1
-        
-        # Rock (type 1)
-        for i in range(rock_count):
-            self.types[idx] = 1
-            idx += 1
-        
-        # Paper (type 2)
-        for i in range(paper_count):
-            self.types[idx] = 2
-            idx += 1
+        # Set types: scissors (0), then rocks (1), then papers (2)
+        self.types[:] = np.repeat(np.arange(3, dtype=np.int8),
+                                  (scissors_count, rock_count, paper_count))
 
     def update(self):
         """Update simulation state for one frame"""
-        # Update targets
-        self.targets = core.find_all_targets(self.positions, self.types)
-        
-        # Update movement
-        self.velocities = core.update_movement(self.positions, self.types, self.targets)
+        # Update targets and movement (the core finds targets in place
+        # unless they come from the NumPy fallback)
+        if not GRID_TARGETS:
+            self.targets = find_targets_np(self.positions, self.types)
+        self.rng.random(dtype=np.float32, out=self._noise)
+        core.update_movement(self.positions, self.types, self.velocities, self.targets,
+                             self._noise, find_targets=GRID_TARGETS, out=self._next_velocities,
+                             buffers=self._grid_buffers)
+        self.velocities, self._next_velocities = self._next_velocities, self.velocities
         
         # Check collisions
-        new_types = core.check_all_collisions(self.positions, self.types)
-        
-        # Apply new types
-        for i in range(self.total_count):
-            if new_types[i] >= 0:
-                self.types[i] = new_types[i]
+        self.rng.random(out=self._rolls)
+        new_types = core.check_all_collisions(self.positions, self.types, self._rolls,
+                                              out=self._new_types, buffers=self._grid_buffers)
+        
+        # Apply new types (and move the converted units between the counts)
+        converted = new_types >= 0
+        if converted.any():
+            self.counts -= np.bincount(self.types[converted], minlength=3)
+            self.counts += np.bincount(new_types[converted], minlength=3)
+            self.types[converted] = new_types[converted]
     
     def draw(self):
         """Draw all units to the screen"""
-        # Draw units
-        for i in range(self.total_count):
-            x, y = int(self.positions[i, 0]), int(self.positions[i, 1])
-            
-            # Set color based on type
-            if self.types[i] == 0:  # Scissors
-                color = SCISSORS_COLOR
-            elif self.types[i] == 1:  # Rock
-                color = ROCK_COLOR
-            else:  # Paper
-                color = PAPER_COLOR
-            
-            # Draw unit
-            pygame.draw.circle(screen, color, (x, y), UNIT_RADIUS)
-            
-            # Draw attraction line to target
-            if SHOW_ATTRACTIONS and self.targets[i] >= 0:
+        # Draw units with a single batched blit of the type sprites, grouped by
+        # type so each group pairs one sprite with a slice of the corners
+        corners = self.positions.astype(np.int32) - UNIT_RADIUS
+        blit_sequence = []
+        for unit_type, sprite in enumerate(self.sprites):
+            group = corners[self.types == unit_type].tolist()
+            blit_sequence += zip(itertools.repeat(sprite, len(group)), group)
+        screen.blits(blit_sequence, doreturn=False)
+        
+        # Draw attraction lines to targets
+        if SHOW_ATTRACTIONS:
+            # Gather both line ends by target index in one go
+            hunters = np.flatnonzero(self.targets >= 0)
+            starts = self.positions[hunters].astype(np.int32).tolist()
+            ends = self.positions[self.targets[hunters]].astype(np.int32).tolist()
+            for start, end in zip(starts, ends):
                 # Draw a line to target (prey) - green line
-                target_x = int(self.positions[self.targets[i], 0])
-                target_y = int(self.positions[self.targets[i], 1])
-                pygame.draw.line(screen, (0, 200, 0), (x, y), (target_x, target_y), 1)
+                pygame.draw.line(screen, (0, 200, 0), start, end, 1)
     
     def check_end_condition(self):
         """Check if simulation has ended (all units same type)"""
-        if self.total_count == 0:
-            return True
-        
-        # Check if all units are the same type
-        first_type = self.types[0]
-        return np.all(self.types == first_type)
+        # At most one type has units left (also true with no units at all)
+        return np.count_nonzero(self.counts) <= 1
         
     def get_type_counts(self):
         """Get counts of each unit type"""
-        unique, counts = np.unique(self.types, return_counts=True)
-        counts_dict = dict(zip(unique, counts))
-        
-        # Ensure all types have counts (even if zero)
-        scissors_count = counts_dict.get(0, 0)
-        rock_count = counts_dict.get(1, 0)
-        paper_count = counts_dict.get(2, 0)
+        scissors_count, rock_count, paper_count = self.counts.tolist()
         
         return scissors_count, rock_count, paper_count
 
-def main():
-    # Get initial counts from command line arguments or use defaults
-    scissors_count = 200
-    rock_count = 200
-    paper_count = 200
-
-    if len(sys.argv) >= 4:
-        scissors_count = int(sys.argv[1])
-        rock_count = int(sys.argv[2])
-        paper_count = int(sys.argv[3])
-
-    # Initialize simulation
-    simulation = CythonSimulation(scissors_count, rock_count, paper_count)
-    running = True
+def main(scissors_count=200, rock_count=200, paper_count=200, max_time=None, headless=False,
+         benchmark=False):
+    """Run the simulation and return the final (scissors, rock, paper) counts.
     
-    # For max time limit
-    time_steps = 0
-    status_message = "Running..."
-    fps_timer = time.time()
-    frame_count = 0
+    max_time overrides MAX_TIME; headless draws to an off-screen surface
+    through SDL's dummy video driver instead of opening a window and runs
+    without the FPS cap, so the simulation can be driven in-process.
+    benchmark implies headless, skips all rendering so only the simulation
+    itself is timed, and prints the time per frame at the end.
+    """
+    global screen
     
-    while running:
-        start_time = time.time()
+    if max_time is None:
+        max_time = MAX_TIME
+    if benchmark:
+        headless = True
+    
+    # Initialize Pygame and the drawing surface
+    if headless:
+        previous_driver = os.environ.get('SDL_VIDEODRIVER')
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    try:
+        pygame.init()
+        if headless:
+            screen = pygame.Surface((WIDTH, HEIGHT))
+        else:
+            screen = pygame.display.set_mode((WIDTH, HEIGHT))
+            pygame.display.set_caption("Rock Paper Scissors Simulation (Cython)")
         
-        # Process events
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
+        # Static background, blitted each frame instead of redrawn
+        background = render_background()
+        if not headless:
+            background = background.convert()
         
-        # Start performance timer for simulation update
-        update_start_time = time.time()
+        # HUD font, loaded once (the font module needs pygame.init)
+        font = pygame.font.SysFont(None, 24)
         
-        # Update simulation
-        simulation.update()
+        # Initialize simulation
+        simulation = CythonSimulation(scissors_count, rock_count, paper_count)
+        running = True
         
-        update_time = time.time() - update_start_time
+        # For max time limit
+        time_steps = 0
+        status_message = "Running..."
+        fps_timer = time.time()
+        frame_count = 0
+        time_text = None
+        run_start_time = time.time()
         
-        # Time limit check
-        time_steps += 1
-        if time_steps >= MAX_TIME:
-            # Determine which type has the most units
-            scissors_remaining, rock_remaining, paper_remaining = simulation.get_type_counts()
+        while running:
+            start_time = time.time()
             
-            counts = [scissors_remaining, rock_remaining, paper_remaining]
-            winner_index = counts.index(max(counts))
-            winner_name = ["Scissors", "Rock", "Paper"][winner_index]
+            # Process events
+            if not headless:
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        running = False
             
-            print(f"Time limit reached! {winner_name} has the most units ({counts[winner_index]})!")
-            status_message = f"Time Limit! {winner_name} leads with {counts[winner_index]} units"
-            running = False
+            # Start performance timer for simulation update
+            update_start_time = time.time()
             
-        # Check end condition
-        if simulation.check_end_condition():
+            # Update simulation
+            simulation.update()
+            
+            update_time = time.time() - update_start_time
+            
+            # Unit counts, shared by the checks and the HUD below
             scissors_remaining, rock_remaining, paper_remaining = simulation.get_type_counts()
-            if sum([scissors_remaining, rock_remaining, paper_remaining]) > 0:
-                # Find winner type
-                if scissors_remaining > 0:
-                    winner_type = 0
-                elif rock_remaining > 0:
-                    winner_type = 1
-                else:
-                    winner_type = 2
+            
+            # Time limit check
+            time_steps += 1
+            if time_steps >= max_time:
+                # Determine which type has the most units
+                counts = [scissors_remaining, rock_remaining, paper_remaining]
+                winner_index = counts.index(max(counts))
+                winner_name = ["Scissors", "Rock", "Paper"][winner_index]
+                
+                print(f"Time limit reached! {winner_name} has the most units ({counts[winner_index]})!")
+                status_message = f"Time Limit! {winner_name} leads with {counts[winner_index]} units"
+                running = False
+            
+            # Check end condition
+            if simulation.check_end_condition():
+                if sum([scissors_remaining, rock_remaining, paper_remaining]) > 0:
+                    # Find winner type
+                    if scissors_remaining > 0:
+                        winner_type = 0
+                    elif rock_remaining > 0:
+                        winner_type = 1
+                    else:
+                        winner_type = 2
                     
-                winner_name = ["Scissors", "Rock", "Paper"][winner_type]
-                print(f"Simulation ended! {winner_name} wins!")
-                status_message = f"Game Over! {winner_name} wins!"
+                    winner_name = ["Scissors", "Rock", "Paper"][winner_type]
+                    print(f"Simulation ended! {winner_name} wins!")
+                    status_message = f"Game Over! {winner_name} wins!"
+                else:
+                    print("Simulation ended with no units left!")
+                    status_message = "Game Over! No units left!"
+                running = False
+            
+            if benchmark:
+                continue
+            
+            # Draw everything
+            screen.blit(background, (0, 0))
+            
+            # Display counts and status
+            count_text = f"Scissors: {scissors_remaining} | Rock: {rock_remaining} | Paper: {paper_remaining}"
+            text = render_text(font, count_text, (255, 255, 255))
+            screen.blit(text, (10, 10))
+            
+            # Status message
+            status_text = render_text(font, status_message, (255, 255, 0))
+            screen.blit(status_text, (WIDTH // 2 - status_text.get_width() // 2, 10))
+            
+            # Calculate frame time and FPS
+            frame_time = time.time() - start_time
+            frame_count += 1
+            if time.time() - fps_timer > 1.0:  # Update FPS every second
+                current_fps = frame_count / (time.time() - fps_timer)
+                fps_timer = time.time()
+                frame_count = 0
             else:
-                print("Simulation ended with no units left!")
-                status_message = "Game Over! No units left!"
-            running = False
-        
-        # Draw everything
-        screen.fill(BACKGROUND_COLOR)
-        
-        # Display counts and status
-        scissors_remaining, rock_remaining, paper_remaining = simulation.get_type_counts()
-        
-        font = pygame.font.SysFont(None, 24)
-        
-        # Count text
-        count_text = f"Scissors: {scissors_remaining} | Rock: {rock_remaining} | Paper: {paper_remaining}"
-        text = font.render(count_text, True, (255, 255, 255))
-        screen.blit(text, (10, 10))
-        
-        # Status message
-        status_text = font.render(status_message, True, (255, 255, 0))
-        screen.blit(status_text, (WIDTH // 2 - status_text.get_width() // 2, 10))
-        
-        # Calculate frame time and FPS
-        frame_time = time.time() - start_time
-        frame_count += 1
-        if time.time() - fps_timer > 1.0:  # Update FPS every second
-            current_fps = frame_count / (time.time() - fps_timer)
-            fps_timer = time.time()
-            frame_count = 0
-        else:
-            current_fps = clock.get_fps()
+                current_fps = clock.get_fps()
             
-        # Time steps and performance info
-        perf_text = f"Time: {time_steps}/{MAX_TIME} | FPS: {int(current_fps)} | Frame: {frame_time*1000:.1f}ms"
-        time_text = font.render(perf_text, True, (200, 200, 200))
-        screen.blit(time_text, (WIDTH - 450, 10))
-        
-        # Detailed performance breakdown
-        breakdown_text = f"Update: {update_time*1000:.1f}ms"
-        breakdown_render = font.render(breakdown_text, True, (150, 150, 150))
-        screen.blit(breakdown_render, (WIDTH - 450, 35))
-        
-        # Draw all units
-        simulation.draw()
-        
-        pygame.display.flip()
-        clock.tick(FPS)
-    
-    pygame.quit()
+            # Time steps and performance info, re-rendered every few frames only
+            # (it changes every frame, so it bypasses the text cache)
+            if time_text is None or time_steps % PERF_TEXT_INTERVAL == 0:
+                perf_text = f"Time: {time_steps}/{max_time} | FPS: {int(current_fps)} | Frame: {frame_time*1000:.1f}ms"
+                time_text = font.render(perf_text, True, (200, 200, 200))
+                
+                # Detailed performance breakdown
+                breakdown_text = f"Update: {update_time*1000:.1f}ms"
+                breakdown_render = font.render(breakdown_text, True, (150, 150, 150))
+            screen.blit(time_text, (WIDTH - 450, 10))
+            screen.blit(breakdown_render, (WIDTH - 450, 35))
+            
+            # Draw all units
+            simulation.draw()
+            
+            if not headless:
+                pygame.display.flip()
+                clock.tick(FPS)
+        
+        if benchmark:
+            run_time = time.time() - run_start_time
+            print(f"Benchmark: {time_steps} frames in {run_time:.2f}s "
+                  f"({run_time / time_steps * 1000:.2f} ms/frame)")
+        
+        pygame.quit()
+        
+        return simulation.get_type_counts()
+    finally:
+        # Give the SDL_VIDEODRIVER setting back to the caller
+        if headless:
+            if previous_driver is None:
+                os.environ.pop('SDL_VIDEODRIVER', None)
+            else:
+                os.environ['SDL_VIDEODRIVER'] = previous_driver
 
 if __name__ == "__main__":
-    main()
+    headless = '--headless' in sys.argv
+    benchmark = '--no-render' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg not in ('--headless', '--no-render')]
+    
+    # Benchmark support: "-b <frames>" runs that many frames without rendering
+    max_time = None
+    if '-b' in args:
+        b_index = args.index('-b')
+        max_time = int(args[b_index + 1])
+        del args[b_index:b_index + 2]
+        benchmark = True
+        print(f'Running in benchmark mode with MAX_TIME={max_time}')
+    
+    # Get initial counts from command line arguments or use defaults
+    if len(args) >= 3:
+        main(int(args[0]), int(args[1]), int(args[2]), max_time=max_time, headless=headless,
+             benchmark=benchmark)
+    else:
+        main(max_time=max_time, headless=headless, benchmark=benchmark)
@@ -1,6 +1,44 @@
 from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
 from Cython.Build import cythonize
 import numpy as np
+import os
+import tempfile
+
+OPENMP_TEST = """
+#include <omp.h>
+int main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }
+"""
+
+def has_openmp_flag(compiler, flag):
+    """Check that a small program using omp.h compiles and links with flag"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "openmp_test.c")
+        with open(source, "w") as f:
+            f.write(OPENMP_TEST)
+        try:
+            objects = compiler.compile([source], output_dir=tmpdir, extra_postargs=[flag])
+            compiler.link_executable(objects, os.path.join(tmpdir, "openmp_test"),
+                                     extra_postargs=[flag])
+        except Exception:
+            return False
+    return True
+
+class build_ext_openmp(build_ext):
+    """build_ext that adds the OpenMP flags the compiler supports, if any"""
+    def build_extensions(self):
+        if self.compiler.compiler_type == "msvc":
+            compile_args, link_args = ["/openmp"], []
+        elif has_openmp_flag(self.compiler, "-fopenmp"):
+            compile_args, link_args = ["-fopenmp"], ["-fopenmp"]
+        else:
+            # Without OpenMP the prange loops simply run serially
+            compile_args, link_args = [], []
+        
+        for ext in self.extensions:
+            ext.extra_compile_args += compile_args
+            ext.extra_link_args += link_args
+        super().build_extensions()
 
 extensions = [
     Extension(
@@ -13,4 +51,5 @@ extensions = [
 
 setup(
     ext_modules=cythonize(extensions, annotate=True),
+    cmdclass={"build_ext": build_ext_openmp},
 )
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The simulation modules live at the repository root; the core has to be
+# built in place first (python setup.py build_ext --inplace)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
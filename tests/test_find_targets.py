@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+core = pytest.importorskip("rock_paper_scissors_core", reason="build the core with setup.py first")
+sim = pytest.importorskip("rock_paper_scissors_sim_cython")
+
+
+def random_units(rng, unit_count, type_count=3):
+    positions = rng.uniform(0, sim.WIDTH, (unit_count, 2)).astype(np.float32)
+    types = rng.integers(0, type_count, unit_count).astype(np.int8)
+    return positions, types
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("unit_count", [1, 2, 50, 600])
+def test_numpy_fallback_matches_core(seed, unit_count):
+    positions, types = random_units(np.random.default_rng(seed), unit_count)
+    
+    expected = core.find_all_targets(positions, types)
+    targets = sim.find_targets_np(positions, types)
+    
+    assert targets.dtype == np.int32
+    np.testing.assert_array_equal(targets, expected)
+
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("unit_count", [1, 2, 50, 600])
+def test_fused_targets_match_find_all_targets(seed, unit_count):
+    rng = np.random.default_rng(seed)
+    positions, types = random_units(rng, unit_count)
+    velocities = rng.uniform(-1, 1, (unit_count, 2)).astype(np.float32)
+    noise = rng.random((unit_count, 2), dtype=np.float32)
+    
+    # update_movement moves the units, so look the targets up beforehand
+    expected = core.find_all_targets(positions, types)
+    np.testing.assert_array_equal(sim.find_targets_np(positions, types), expected)
+    
+    targets = np.empty(unit_count, dtype=np.int32)
+    core.update_movement(positions, types, velocities, targets, noise, find_targets=True)
+    
+    np.testing.assert_array_equal(targets, expected)
+
+def test_numpy_fallback_without_prey():
+    # Only scissors and rocks: rocks hunt scissors, nobody hunts rocks
+    positions, types = random_units(np.random.default_rng(0), 40, type_count=2)
+    
+    targets = sim.find_targets_np(positions, types)
+    
+    np.testing.assert_array_equal(targets, core.find_all_targets(positions, types))
+    assert (targets[types == 0] == -1).all()
+
+
+def test_numpy_fallback_without_units():
+    positions = np.empty((0, 2), dtype=np.float32)
+    types = np.empty(0, dtype=np.int8)
+    
+    targets = sim.find_targets_np(positions, types)
+    
+    assert targets.dtype == np.int32
+    assert targets.shape == (0,)
+
+
+def test_main_with_numpy_targets(monkeypatch):
+    monkeypatch.setattr(sim, "GRID_TARGETS", False)
+    
+    assert sim.main(0, 0, 0, max_time=5, headless=True) == (0, 0, 0)
+    assert sum(sim.main(5, 5, 5, max_time=5, headless=True)) == 15
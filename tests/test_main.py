@@ -0,0 +1,18 @@
+import os
+
+import pytest
+
+pytest.importorskip("rock_paper_scissors_core", reason="build the core with setup.py first")
+sim = pytest.importorskip("rock_paper_scissors_sim_cython")
+
+
+@pytest.mark.parametrize("driver", [None, "offscreen"])
+def test_headless_restores_video_driver(monkeypatch, driver):
+    if driver is None:
+        monkeypatch.delenv("SDL_VIDEODRIVER", raising=False)
+    else:
+        monkeypatch.setenv("SDL_VIDEODRIVER", driver)
+    
+    sim.main(5, 5, 5, max_time=5, headless=True)
+    
+    assert os.environ.get("SDL_VIDEODRIVER") == driver